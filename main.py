@@ -1,22 +1,310 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager, suppress
+from datetime import date
 from datetime import datetime  # Added for spending status calculations
+from datetime import time
 from datetime import timezone
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-import json  # Ensure json is imported at the top
 import os  # Added for API key
 
 import httpx  # Added for making HTTP requests to Rye
+import orjson
+import redis.asyncio as redis
+from cachetools import TTLCache
 from fastapi import FastAPI
 from fastmcp import FastMCP, Image
 from firecrawl import FirecrawlApp  # Added for Firecrawl
-from supabase import Client, create_client  # Added for supabase-py
+from supabase import (  # Added for supabase-py
+    Client,
+    ClientOptions,
+    PostgrestAPIError,
+    create_client,
+)
 
 # 3. Create the FastMCP server instance
 mcp_server = FastMCP("Poltergeist MCP Server 👻")
 
+# Rye GraphQL API (staging); settings are read once at import
+RYE_ENDPOINT = "/v1/query"
+_RYE_AUTH = os.environ.get("RYE_AUTH_HEADER")
+_RYE_IP = os.environ.get("RYE_SHOPPER_IP")
+_RYE_CONFIGURED = bool(_RYE_AUTH and _RYE_IP)
+_RYE_HEADERS = {
+    "Authorization": _RYE_AUTH or "",
+    "Rye-Shopper-IP": _RYE_IP or "",
+    "Content-Type": "application/json",
+}
+
+# Shared Rye client: one keep-alive pool (HTTP/2 multiplexed) for every Rye tool
+# instead of a fresh TCP + TLS handshake per call. Closed in the app lifespan.
+RYE_CLIENT = httpx.AsyncClient(
+    base_url="https://staging.graphql.api.rye.com",  # Using staging
+    headers=_RYE_HEADERS,
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=200, max_keepalive_connections=100, keepalive_expiry=120
+    ),
+    timeout=httpx.Timeout(10.0),
+)
+
+_FIRECRAWL = (
+    FirecrawlApp(api_key=os.environ["FIRECRAWL_API_KEY"])
+    if os.environ.get("FIRECRAWL_API_KEY")
+    else None
+)
+
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_SERVICE_ROLE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_supabase() -> Client:
+    """Returns the shared Supabase client, built once so its HTTP sessions stay warm."""
+    return create_client(
+        SUPABASE_URL,
+        SUPABASE_SERVICE_ROLE_KEY,
+        options=ClientOptions(postgrest_client_timeout=10),
+    )
+
+
+# -------------------- Upstream call helpers --------------------
+class UpstreamError(Exception):
+    """A failed Rye/Supabase call, carrying the error response the tool returns."""
+
+    def __init__(self, error: str, details=None):
+        super().__init__(error)
+        self.error = error
+        self.details = details
+
+    def as_response(self) -> dict:
+        if self.details is None:
+            return {"error": self.error}
+        return {"error": self.error, "details": self.details}
+
+
+def _dig(d, *keys, default=None):
+    """Walks nested dicts along `keys`, returning `default` at the first missing,
+    null or non-dict step (without allocating placeholder dicts on the way).
+    """
+    for key in keys:
+        if not isinstance(d, dict):
+            return default
+        d = d.get(key)
+        if d is None:
+            return default
+    return d
+
+
+async def _rye_post(query: str, variables: dict) -> dict:
+    """Posts a GraphQL document to Rye and returns its `data`.
+
+    HTTP, transport, decoding and GraphQL-level failures all raise UpstreamError.
+    """
+    try:
+        resp = await RYE_CLIENT.post(
+            RYE_ENDPOINT,
+            content=orjson.dumps({"query": query, "variables": variables}),
+        )
+        resp.raise_for_status()
+        payload = orjson.loads(resp.content)
+    except httpx.HTTPStatusError as e:
+        raise UpstreamError(
+            f"HTTP error occurred while contacting Rye: {e.response.status_code}",
+            e.response.text,
+        ) from e
+    except httpx.RequestError as e:
+        raise UpstreamError(
+            f"Request error occurred while contacting Rye: {str(e)}"
+        ) from e
+    except orjson.JSONDecodeError as e:
+        raise UpstreamError("Rye returned invalid JSON", str(e)) from e
+    if payload.get("errors"):
+        raise UpstreamError("GraphQL error from Rye", payload["errors"])
+    data = payload.get("data")
+    if not data:
+        raise UpstreamError("No data in Rye response", payload)
+    return data
+
+
+async def _sb_exec(query, error: str):
+    """Executes a supabase-py query in a worker thread (the client is synchronous).
+
+    PostgREST failures raise UpstreamError with `error` as the message.
+    """
+    try:
+        return await asyncio.to_thread(query.execute)
+    except PostgrestAPIError as e:
+        raise UpstreamError(error, e.message or str(e)) from e
+
+
+# -------------------- Caching --------------------
+# Product metadata and search results rarely change minute to minute. Lookups go
+# to a per-process TTLCache first, then Redis (shared across workers, optional).
+CACHE_TTL_SECONDS = 300
+REDIS_URL = os.environ.get("REDIS_URL")
+# Short socket timeouts: an unreachable Redis must degrade to an L1-only miss, not a stall
+_REDIS = (
+    redis.Redis.from_url(
+        REDIS_URL,
+        max_connections=20,
+        socket_connect_timeout=0.3,
+        socket_timeout=0.3,
+    )
+    if REDIS_URL
+    else None
+)
+_PRODUCT_CACHE = TTLCache(maxsize=1024, ttl=CACHE_TTL_SECONDS)
+_RESEARCH_CACHE = TTLCache(maxsize=1024, ttl=CACHE_TTL_SECONDS)
+# Carts just created in this process, so checkout can skip re-fetching them from Rye
+_CART_CACHE = TTLCache(maxsize=256, ttl=60)
+
+
+async def _cache_get(l1: TTLCache, namespace: str, key: str):
+    """Returns the cached value for `key`, promoting Redis hits into `l1`; None on a miss."""
+    value = l1.get(key)
+    if value is not None or _REDIS is None:
+        return value
+    try:
+        raw = await _REDIS.get(f"poltergeist:{namespace}:{key}")
+        if raw is None:
+            return None
+        value = orjson.loads(raw)
+    except (redis.RedisError, orjson.JSONDecodeError):
+        return None  # Redis is only a cache; fall through to the upstream API
+    l1[key] = value
+    return value
+
+
+async def _cache_set(l1: TTLCache, namespace: str, key: str, value) -> None:
+    """Stores `value` in `l1` and, when configured, in Redis with the same TTL."""
+    l1[key] = value
+    if _REDIS is not None:
+        try:
+            await _REDIS.setex(
+                f"poltergeist:{namespace}:{key}", CACHE_TTL_SECONDS, orjson.dumps(value)
+            )
+        except redis.RedisError:
+            pass
+
+
+async def _cache_delete(l1: TTLCache, namespace: str, key: str) -> None:
+    """Drops `key` from both cache layers."""
+    l1.pop(key, None)
+    if _REDIS is not None:
+        try:
+            await _REDIS.delete(f"poltergeist:{namespace}:{key}")
+        except redis.RedisError:
+            pass
+
+
+# -------------------- Rye GraphQL documents --------------------
+# Cheapest valid query; only used to open the pooled connection at startup
+_Q_WARMUP = "query Warmup { __typename }"
+
+_M_REQUEST_AMAZON = """
+mutation RequestAmazonProductByURL($input: RequestAmazonProductByURLInput!) {
+    requestAmazonProductByURL(input: $input) {
+        productId
+    }
+}
+"""
+
+_Q_PRODUCT_DETAILS = """
+query ProductDetails($input: ProductByIDInput!) {
+    product: productByID(input: $input) {
+        title
+        url
+        isAvailable
+        price { displayValue value currency }
+        images { url }
+        ... on AmazonProduct {
+            ASIN
+        }
+    }
+}
+"""
+
+# Updated mutation to fetch more details, especially stores and cartLines
+_M_CREATE_CART = """
+mutation CreateCart($input: CartCreateInput!) {
+    createCart(input: $input) {
+        cart {
+            id
+            cost {
+                total { value displayValue currency }
+                subtotal { value displayValue currency }
+                shipping { value displayValue currency }
+                tax { value displayValue currency }
+                isEstimated
+            }
+            stores {
+                ... on AmazonStore {
+                    cartLines {
+                        quantity
+                        product { # Same fields as fetch_amazon_product_details, so no separate lookup is needed
+                            id
+                            title
+                            url
+                            isAvailable
+                            price { displayValue value currency }
+                            images { url }
+                            ... on AmazonProduct {
+                                ASIN
+                            }
+                        }
+                    }
+                    errors { # Errors specific to this store
+                        code
+                        message
+                    }
+                }
+                # Could add ShopifyStore or other types if needed
+            }
+        }
+        errors { # Top-level errors for the createCart mutation
+            code
+            message
+        }
+    }
+}
+"""
+
+# Adjusted query based on error hints: getCart returns an object
+# that has a 'cart' field (of type Cart) and an 'errors' field.
+_Q_GET_CART = """
+query GetCart($id: ID!) {
+  getCart(id: $id) {
+    cart {
+      id
+      cost {
+        total { value currency }
+        subtotal { value currency }
+        shipping { value currency }
+        tax { value currency }
+      }
+      stores {
+        ... on AmazonStore {
+          cartLines {
+            quantity
+            product {
+              id
+              title
+              price { value currency }
+            }
+          }
+        }
+      }
+    }
+    errors { code message }
+  }
+}
+"""
+
 
 # 4. Define MCP tools on the mcp_server instance
 @mcp_server.tool()
@@ -28,29 +316,33 @@ def get_server_status() -> str:
 @mcp_server.tool()
 async def research_products(query: str) -> dict:
     """Researches products based on a query using Firecrawl and returns a list of results."""
-    api_key = os.environ.get("FIRECRAWL_API_KEY")
-    if not api_key:
+    if _FIRECRAWL is None:
         return {"error": "FIRECRAWL_API_KEY not set."}
 
+    cached = await _cache_get(_RESEARCH_CACHE, "research", query)
+    if cached is not None:
+        return {"results": cached}
+
     try:
-        firecrawl_client = FirecrawlApp(api_key=api_key)
-        # Firecrawl search API: use page_options keyword, not "params"
-        search_resp = firecrawl_client.search(query, limit=10)
+        # Firecrawl search API: use page_options keyword, not "params".
+        # The SDK is synchronous (requests), so keep it off the event loop
+        search_resp = await asyncio.to_thread(_FIRECRAWL.search, query, limit=10)
         search_results = (
             search_resp.data if hasattr(search_resp, "data") else search_resp
         )
 
-        # Let's extract and return relevant info, like URLs and snippets/titles
-        processed_results = []
+        # Let's extract and return relevant info, like URLs and snippets/titles.
+        # Hits without a URL are useless to the caller, so they are dropped rather than padded
         if search_results:
-            for result in search_results:
-                processed_results.append(
-                    {
-                        "title": result.get("title", "N/A"),
-                        "url": result.get("url", "N/A"),
-                        "snippet": result.get("description", ""),
-                    }
-                )
+            processed_results = [
+                {
+                    "title": result.get("title"),
+                    "url": url,
+                    "snippet": result.get("description", ""),
+                }
+                for result in search_results
+                if (url := result.get("url"))
+            ]
         else:
             # Handle cases where the output might be different, e.g. a single dict or error
             # Based on firecrawl client, .search returns List[SearchResult]
@@ -60,6 +352,7 @@ async def research_products(query: str) -> dict:
                 "details": str(search_results),
             }
 
+        await _cache_set(_RESEARCH_CACHE, "research", query, processed_results)
         return {"results": processed_results}
     except Exception as e:
         return {"error": f"An error occurred during Firecrawl search: {str(e)}"}
@@ -68,150 +361,136 @@ async def research_products(query: str) -> dict:
 @mcp_server.tool()
 async def request_amazon_product_tracking(product_url: str) -> dict:
     """Requests Rye to start tracking an Amazon product by its URL and returns the Rye productId."""
-    rye_auth_header = os.environ.get("RYE_AUTH_HEADER")
-    rye_shopper_ip = os.environ.get("RYE_SHOPPER_IP")
-    rye_graphql_endpoint = (
-        "https://staging.graphql.api.rye.com/v1/query"  # Using staging
-    )
-
-    if not all([rye_auth_header, rye_shopper_ip]):
+    if not _RYE_CONFIGURED:
         return {
             "error": "RYE_AUTH_HEADER or RYE_SHOPPER_IP not set in environment variables."
         }
 
-    headers = {
-        "Authorization": rye_auth_header,
-        "Rye-Shopper-IP": rye_shopper_ip,
-        "Content-Type": "application/json",
-    }
-
-    query = """
-    mutation RequestAmazonProductByURL($input: RequestAmazonProductByURLInput!) {
-        requestAmazonProductByURL(input: $input) {
-            productId
-        }
-    }
-    """
-    variables = {"input": {"url": product_url}}
-
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                rye_graphql_endpoint,
-                json={"query": query, "variables": variables},
-                headers=headers,
-            )
-            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-
-            response_data = response.json()
-            if response_data.get("errors"):
-                return {
-                    "error": "GraphQL error from Rye",
-                    "details": response_data["errors"],
-                }
-
-            product_id = (
-                response_data.get("data", {})
-                .get("requestAmazonProductByURL", {})
-                .get("productId")
-            )
-            if not product_id:
-                return {
-                    "error": "productId not found in Rye response",
-                    "details": response_data,
-                }
-
-            return {"productId": product_id}
-
-    except httpx.HTTPStatusError as e:
-        return {
-            "error": f"HTTP error occurred while contacting Rye: {e.response.status_code}",
-            "details": e.response.text,
-        }
-    except httpx.RequestError as e:
-        return {"error": f"Request error occurred while contacting Rye: {str(e)}"}
+        data = await _rye_post(_M_REQUEST_AMAZON, {"input": {"url": product_url}})
+    except UpstreamError as e:
+        return e.as_response()
     except Exception as e:
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
+    product_id = _dig(data, "requestAmazonProductByURL", "productId")
+    if not product_id:
+        return {"error": "productId not found in Rye response", "details": data}
+
+    return {"productId": product_id}
+
 
 @mcp_server.tool()
 async def fetch_amazon_product_details(product_id: str) -> dict:
     """Fetch detailed info for an Amazon product already tracked in Rye using its productId / ASIN."""
-    rye_auth_header = os.environ.get("RYE_AUTH_HEADER")
-    rye_shopper_ip = os.environ.get("RYE_SHOPPER_IP")
-    rye_graphql_endpoint = "https://staging.graphql.api.rye.com/v1/query"
-
-    if not all([rye_auth_header, rye_shopper_ip]):
+    if not _RYE_CONFIGURED:
         return {
             "error": "RYE_AUTH_HEADER or RYE_SHOPPER_IP not set in environment variables."
         }
 
-    headers = {
-        "Authorization": rye_auth_header,
-        "Rye-Shopper-IP": rye_shopper_ip,
-        "Content-Type": "application/json",
-    }
-
-    query = """
-    query ProductDetails($input: ProductByIDInput!) {
-        product: productByID(input: $input) {
-            title
-            url
-            isAvailable
-            price { displayValue value currency }
-            images { url }
-            ... on AmazonProduct {
-                ASIN
-            }
-        }
-    }
-    """
-    variables = {"input": {"id": product_id, "marketplace": "AMAZON"}}
+    product = await _cache_get(_PRODUCT_CACHE, "product", product_id)
+    if product is None:
+        variables = {"input": {"id": product_id, "marketplace": "AMAZON"}}
+        try:
+            data = await _rye_post(_Q_PRODUCT_DETAILS, variables)
+        except UpstreamError as e:
+            return e.as_response()
+        except Exception as e:
+            return {"error": str(e)}
+        product = data.get("product")
+        if not product:
+            return {"error": "Product not found", "details": data}
+        await _cache_set(_PRODUCT_CACHE, "product", product_id, product)
+
+    # convert images to fastmcp.Image objects for Claude previews
+    img_objs = []
+    for img in product.get("images") or ():
+        if isinstance(img, dict) and img.get("url"):
+            img_objs.append(Image(img["url"]))
+    # copy, so the cached product never holds the (unserializable) previews
+    return {**product, "image_previews": img_objs}
+
+
+# 5. Get the ASGI app from FastMCP using streamable HTTP (less framing than SSE)
+mcp_asgi_app = mcp_server.http_app(transport="streamable-http")  # Provides /mcp
+# Legacy SSE endpoints (/sse + /messages/) on the same mount for proxy clients that
+# don't speak streamable HTTP yet; the SSE app has no lifespan of its own to run
+mcp_sse_app = mcp_server.http_app(transport="sse")
+mcp_asgi_app.router.routes.extend(mcp_sse_app.routes)
+
+
+async def _warm_rye() -> None:
+    """Opens the TCP/TLS (HTTP/2) connection to Rye so the first tool call doesn't pay for it."""
+    # Best effort: a slow or unreachable Rye surfaces on the first real tool call instead
+    with suppress(httpx.HTTPError):
+        await RYE_CLIENT.post(
+            RYE_ENDPOINT, content=orjson.dumps({"query": _Q_WARMUP}), timeout=2.0
+        )
 
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                rye_graphql_endpoint,
-                json={"query": query, "variables": variables},
-                headers=headers,
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            if data.get("errors"):
-                return {"error": "GraphQL error", "details": data["errors"]}
-            product = data.get("data", {}).get("product")
-            if not product:
-                return {"error": "Product not found", "details": data}
-            # convert images to fastmcp.Image objects for Claude previews
-            img_objs = []
-            for img in product.get("images", []):
-                if isinstance(img, dict) and img.get("url"):
-                    img_objs.append(Image(img["url"]))
-            product["image_previews"] = img_objs
-            return product
-    except httpx.HTTPStatusError as e:
-        return {
-            "error": f"HTTP error {e.response.status_code}",
-            "details": e.response.text,
-        }
-    except Exception as e:
-        return {"error": str(e)}
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs the FastMCP lifespan, pre-warms the Rye connection and closes the shared clients on shutdown."""
+    async with mcp_asgi_app.router.lifespan_context(app):
+        # In the background, so startup never waits on Rye
+        warmup = asyncio.create_task(_warm_rye()) if _RYE_CONFIGURED else None
+        try:
+            yield
+        finally:
+            if warmup is not None:
+                warmup.cancel()
+                with suppress(asyncio.CancelledError):
+                    await warmup
+            await RYE_CLIENT.aclose()
+            if _REDIS is not None:
+                await _REDIS.aclose()
 
-# 5. Get the ASGI app from FastMCP using SSE transport (easier for proxy clients)
-mcp_asgi_app = mcp_server.http_app(transport="sse")  # Provides /sse endpoint
 
 # Create FastAPI app with lifespan
-app = FastAPI(lifespan=mcp_asgi_app.router.lifespan_context)
-
-
-@app.get("/")
-async def root():
-    return {"message": "Poltergeist Server is alive! FastAPI root accessible."}
+app = FastAPI(lifespan=lifespan)
+
+
+_ROOT_BODY = orjson.dumps(
+    {"message": "Poltergeist Server is alive! FastAPI root accessible."}
+)
+_NOT_FOUND_BODY = orjson.dumps({"detail": "Not Found"})
+_NOT_ALLOWED_BODY = orjson.dumps({"detail": "Method Not Allowed"})
+MCP_MOUNT_PATH = "/poltergeist_mcp"
+
+
+async def root_asgi(scope, receive, send):
+    """Pure-ASGI health check for `/`, skipping FastAPI's request/response wrapping."""
+    if scope["type"] == "websocket":
+        await send({"type": "websocket.close", "code": 1000})
+        return
+    if scope["type"] != "http":
+        return
+    headers = [(b"content-type", b"application/json")]
+    if scope["path"] == MCP_MOUNT_PATH:
+        # The catch-all hides FastAPI's trailing-slash redirect for the MCP mount
+        location = f"{MCP_MOUNT_PATH}/"
+        if scope["query_string"]:
+            location += "?" + scope["query_string"].decode("latin-1")
+        status, body = 307, b""
+        headers = [(b"location", location.encode("latin-1"))]
+    elif scope["path"] != "/":
+        status, body = 404, _NOT_FOUND_BODY
+    elif scope["method"] in ("GET", "HEAD"):
+        status, body = 200, _ROOT_BODY
+    else:
+        status, body = 405, _NOT_ALLOWED_BODY
+        headers.append((b"allow", b"GET, HEAD"))
+    headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    if scope["method"] == "HEAD":
+        body = b""
+    await send({"type": "http.response.body", "body": body})
 
 
 # Mount at /poltergeist_mcp
-app.mount("/poltergeist_mcp", mcp_asgi_app)
+app.mount(MCP_MOUNT_PATH, mcp_asgi_app)
+# Catch-all: must stay the last mount
+app.mount("/", root_asgi)
 
 # -------------------- Supabase Tools --------------------
 
@@ -220,56 +499,10 @@ app.mount("/poltergeist_mcp", mcp_asgi_app)
 
 @mcp_server.tool()
 async def create_amazon_cart(product_id: str, quantity: int = 1) -> dict:
-    """Create a Rye cart containing the given Amazon product. Returns cart info including cartId, cost, and items."""
-    rye_auth_header = os.environ.get("RYE_AUTH_HEADER")
-    rye_shopper_ip = os.environ.get("RYE_SHOPPER_IP")
-    rye_graphql_endpoint = "https://staging.graphql.api.rye.com/v1/query"
-
-    if not all([rye_auth_header, rye_shopper_ip]):
+    """Create a Rye cart containing the given Amazon product. Returns cart info including cartId, cost, and items (with full product details)."""
+    if not _RYE_CONFIGURED:
         return {"error": "RYE_AUTH_HEADER or RYE_SHOPPER_IP not set"}
 
-    headers = {
-        "Authorization": rye_auth_header,
-        "Rye-Shopper-IP": rye_shopper_ip,
-        "Content-Type": "application/json",
-    }
-
-    # Updated mutation to fetch more details, especially stores and cartLines
-    mutation = """
-    mutation CreateCart($input: CartCreateInput!) {
-        createCart(input: $input) {
-            cart {
-                id
-                cost {
-                    total { value displayValue currency }
-                    subtotal { value displayValue currency }
-                    shipping { value displayValue currency }
-                    isEstimated
-                }
-                stores {
-                    ... on AmazonStore {
-                        cartLines {
-                            quantity
-                            product {
-                                id
-                                title
-                            }
-                        }
-                        errors { # Errors specific to this store
-                            code
-                            message
-                        }
-                    }
-                    # Could add ShopifyStore or other types if needed
-                }
-            }
-            errors { # Top-level errors for the createCart mutation
-                code
-                message
-            }
-        }
-    }
-    """
     input_obj = {
         # "cartSettings": {"amazonSettings": {"fulfilledByAmazon": True}}, # Let's simplify and remove this for now
         "items": {
@@ -280,249 +513,261 @@ async def create_amazon_cart(product_id: str, quantity: int = 1) -> dict:
     variables = {"input": input_obj}
 
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                rye_graphql_endpoint,
-                json={"query": mutation, "variables": variables},
-                headers=headers,
-            )
-            resp.raise_for_status()  # Handles HTTP-level errors
-
-            response_data = resp.json()
-
-            if response_data.get("errors"):
-                return {
-                    "error": "GraphQL top-level error during cart creation",
-                    "details": response_data["errors"],
-                }
+        data = await _rye_post(_M_CREATE_CART, variables)
+        create_cart_payload = data.get("createCart")
+        if not create_cart_payload:
+            return {
+                "error": "Cart creation failed, 'createCart' payload missing",
+                "details": data,
+            }
 
-            create_cart_payload = response_data.get("data", {}).get("createCart")
-            if not create_cart_payload:
-                return {
-                    "error": "Cart creation failed, 'createCart' payload missing",
-                    "details": response_data,
-                }
+        if create_cart_payload.get("errors"):
+            return {
+                "error": "GraphQL error within createCart mutation result",
+                "details": create_cart_payload["errors"],
+            }
 
-            if create_cart_payload.get("errors"):
-                return {
-                    "error": "GraphQL error within createCart mutation result",
-                    "details": create_cart_payload["errors"],
-                }
+        cart_object = create_cart_payload.get("cart")
+        if not cart_object or not cart_object.get("id"):
+            return {
+                "error": "Cart ID not found in successful cart creation",
+                "details": create_cart_payload,
+            }
 
-            cart_object = create_cart_payload.get("cart")
-            if not cart_object or not cart_object.get("id"):
-                return {
-                    "error": "Cart ID not found in successful cart creation",
-                    "details": create_cart_payload,
-                }
+        # Stricter validation: Check if stores and cartLines exist and are populated
+        if (
+            not cart_object.get("stores")
+            or not isinstance(cart_object["stores"], list)
+            or len(cart_object["stores"]) == 0
+            or not cart_object["stores"][0].get("cartLines")
+            or not isinstance(cart_object["stores"][0]["cartLines"], list)
+            or len(cart_object["stores"][0]["cartLines"]) == 0
+        ):
+            # Usually a stock/availability change: don't keep serving stale product details
+            await _cache_delete(_PRODUCT_CACHE, "product", product_id)
+            return {
+                "error": "Cart created but appears empty or item not added successfully.",
+                "details": "No stores or cartLines found in the response, or they are empty.",
+                "cart_details_received": cart_object,  # include what we got for debugging
+            }
 
-            # Stricter validation: Check if stores and cartLines exist and are populated
-            if (
-                not cart_object.get("stores")
-                or not isinstance(cart_object["stores"], list)
-                or len(cart_object["stores"]) == 0
-                or not cart_object["stores"][0].get("cartLines")
-                or not isinstance(cart_object["stores"][0]["cartLines"], list)
-                or len(cart_object["stores"][0]["cartLines"]) == 0
-            ):
+        # Check for store-level errors
+        for store in cart_object.get("stores", []):
+            if store.get("errors") and len(store["errors"]) > 0:
+                await _cache_delete(_PRODUCT_CACHE, "product", product_id)
                 return {
-                    "error": "Cart created but appears empty or item not added successfully.",
-                    "details": "No stores or cartLines found in the response, or they are empty.",
-                    "cart_details_received": cart_object,  # include what we got for debugging
+                    "error": "Store-level error reported during cart creation.",
+                    "details": store["errors"],
+                    "cart_details_received": cart_object,
                 }
 
-            # Check for store-level errors
-            for store in cart_object.get("stores", []):
-                if store.get("errors") and len(store["errors"]) > 0:
-                    return {
-                        "error": "Store-level error reported during cart creation.",
-                        "details": store["errors"],
-                        "cart_details_received": cart_object,
-                    }
+        _CART_CACHE[cart_object["id"]] = cart_object
+        return create_cart_payload  # Return the successful payload
 
-            return create_cart_payload  # Return the successful payload
-
-    except httpx.HTTPStatusError as e:
-        return {
-            "error": f"HTTP error during cart creation: {e.response.status_code}",
-            "details": e.response.text,
-        }
+    except UpstreamError as e:
+        return e.as_response()
     except Exception as e:
         return {"error": f"An unexpected error occurred during cart creation: {str(e)}"}
 
 
+@mcp_server.tool()
+async def track_and_create_cart(product_url: str, quantity: int = 1) -> dict:
+    """Tracks an Amazon product by URL and creates a Rye cart for it in one tool call. Returns the same payload as create_amazon_cart."""
+    # Rye can't feed the tracked productId into createCart within one GraphQL document,
+    # so this is two mutations; the cart lines already carry the product details.
+    tracking = await request_amazon_product_tracking(product_url)
+    if tracking.get("error"):
+        return tracking
+    return await create_amazon_cart(tracking["productId"], quantity)
+
+
 # Tool to get cart details
 @mcp_server.tool()
 async def get_rye_cart_details(cart_id: str) -> dict:
     """Fetches the full details of a given Rye cart by its ID."""
-    rye_auth_header = os.environ.get("RYE_AUTH_HEADER")
-    rye_shopper_ip = os.environ.get("RYE_SHOPPER_IP")
-    rye_graphql_endpoint = "https://staging.graphql.api.rye.com/v1/query"
-
-    if not all([rye_auth_header, rye_shopper_ip]):
+    if not _RYE_CONFIGURED:
         return {"error": "RYE_AUTH_HEADER or RYE_SHOPPER_IP not set"}
 
-    headers = {
-        "Authorization": rye_auth_header,
-        "Rye-Shopper-IP": rye_shopper_ip,
-        "Content-Type": "application/json",
-    }
+    try:
+        data = await _rye_post(_Q_GET_CART, {"id": cart_id})
 
-    # Adjusted query based on error hints: getCart returns an object
-    # that has a 'cart' field (of type Cart) and an 'errors' field.
-    query = """
-    query GetCart($id: ID!) {
-      getCart(id: $id) {
-        cart {
-          id
-          cost {
-            total { value currency }
-            subtotal { value currency }
-            shipping { value currency }
-            tax { value currency }
-          }
-          stores {
-            ... on AmazonStore {
-              cartLines {
-                quantity
-                product {
-                  id
-                  title
-                  price { value currency }
-                }
-              }
+        get_cart_response_payload = data.get("getCart")
+        if not get_cart_response_payload:
+            return {
+                "error": "No 'getCart' payload in response data",
+                "details": data,
             }
-          }
-        }
-        errors { code message }
-      }
-    }
-    """
-    variables = {"id": cart_id}
 
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                rye_graphql_endpoint,
-                json={"query": query, "variables": variables},
-                headers=headers,
-            )
-            resp.raise_for_status()
-            response_data = resp.json()
+        # Check for errors returned by the getCart operation itself
+        if get_cart_response_payload.get("errors"):
+            return {
+                "error": "GraphQL error reported by getCart operation",
+                "details": get_cart_response_payload["errors"],
+            }
 
-            # Check for GraphQL errors at the query execution level (e.g. malformed query, though less likely here)
-            if response_data.get("errors"):
-                return {
-                    "error": "GraphQL top-level execution error fetching cart details",
-                    "details": response_data["errors"],
-                }
+        cart_details = get_cart_response_payload.get("cart")
+        if not cart_details:
+            return {
+                "error": "Could not retrieve nested 'cart' details or cart not found",
+                "details": get_cart_response_payload,
+            }
 
-            get_cart_response_payload = response_data.get("data", {}).get("getCart")
-            if not get_cart_response_payload:
-                return {
-                    "error": "No 'getCart' payload in response data",
-                    "details": response_data,
-                }
+        return cart_details  # Return the actual cart object
 
-            # Check for errors returned by the getCart operation itself
-            if get_cart_response_payload.get("errors"):
-                return {
-                    "error": "GraphQL error reported by getCart operation",
-                    "details": get_cart_response_payload["errors"],
-                }
+    except UpstreamError as e:
+        return e.as_response()
+    except Exception as e:
+        return {"error": f"Unexpected error fetching cart: {str(e)}"}
 
-            cart_details = get_cart_response_payload.get("cart")
-            if not cart_details:
-                return {
-                    "error": "Could not retrieve nested 'cart' details or cart not found",
-                    "details": get_cart_response_payload,
-                }
 
-            return cart_details  # Return the actual cart object
+def _cart_total_cents(cart: dict) -> tuple[int, str | None]:
+    """Order total in integer cents (as Rye returns it) and its currency.
+
+    Uses cost.total, or subtotal + shipping + tax when the total is missing.
+    Raises ValueError if an amount is not an integer.
+    """
+
+    def cents(field: str) -> int:
+        value = _dig(cart, "cost", field, "value", default=0)
+        if type(value) is not int:
+            raise ValueError(f"cost.{field}.value is not integer cents: {value!r}")
+        return value
+
+    if _dig(cart, "cost", "total", "value") is not None:
+        return cents("total"), _dig(cart, "cost", "total", "currency")
+    fields = ("subtotal", "shipping", "tax")
+    # assume single currency across fields
+    currency = next(
+        filter(None, (_dig(cart, "cost", f, "currency") for f in fields)), None
+    )
+    return sum(cents(f) for f in fields), currency
 
-    except httpx.HTTPStatusError as e:
-        return {
-            "error": f"HTTP error fetching cart: {e.response.status_code}",
-            "details": e.response.text,
-        }
-    except Exception as e:
-        return {"error": f"Unexpected error fetching cart: {str(e)}"}
+
+def _usable_cart_snapshot(snapshot: dict, cart_id: str) -> bool:
+    """Whether a client-supplied cart can stand in for re-fetching it from Rye.
+
+    It must carry its own amounts (no defaulting to 0) and only complete lines,
+    since the recorded total feeds the spending-limit checks.
+    """
+    if snapshot.get("id") != cart_id:
+        return False
+    if type(_dig(snapshot, "cost", "total", "value")) is not int and not all(
+        type(_dig(snapshot, "cost", f, "value")) is int
+        for f in ("subtotal", "shipping", "tax")
+    ):
+        return False
+    stores = snapshot.get("stores")
+    if not isinstance(stores, list) or not all(isinstance(s, dict) for s in stores):
+        return False
+    lines = []
+    for store in stores:
+        cart_lines = store.get("cartLines") or []
+        if not isinstance(cart_lines, list):
+            return False
+        lines.extend(cart_lines)
+    if not lines or not all(
+        isinstance(line, dict)
+        and type(line.get("quantity")) is int
+        and _dig(line, "product", "id")
+        for line in lines
+    ):
+        return False
+    try:
+        _cart_total_cents(snapshot)
+    except ValueError:
+        return False
+    return True
 
 
 @mcp_server.tool()
-async def checkout_amazon_cart(cart_id: str, buyer_info: dict) -> dict:
-    """Stores checkout event in Supabase without contacting Rye. buyer_info must include at least an email."""
+async def checkout_amazon_cart(
+    cart_id: str, buyer_info: dict, cart_snapshot: dict | None = None
+) -> dict:
+    """Stores checkout event in Supabase. buyer_info must include at least an email.
+
+    Pass the `cart` returned by create_amazon_cart as `cart_snapshot` to skip
+    re-fetching the cart from Rye; it is only used if the server no longer has
+    the cart cached, its id matches, it has an integer cost.total (or integer
+    subtotal, shipping and tax), and every one of its (at least one) cart lines
+    has a product id and an integer quantity. Otherwise the cart is fetched.
+    """
     # Standalone checkout: record the cart event in Supabase without actual transaction
-    supabase_url = os.environ.get("SUPABASE_URL")
-    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-    if not supabase_url or not supabase_key:
+    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
         return {"error": "Supabase URL or service role key not configured."}
-    # Fetch cart details to capture cost and items
-    cart_details = await get_rye_cart_details(cart_id)
-    print(
-        f"checkout_amazon_cart: cart_details = {cart_details}"
-    )  # Debug raw cart_details
-    if not isinstance(cart_details, dict):
-        return {"error": "Invalid cart details received", "details": str(cart_details)}
-    if cart_details.get("error"):
-        return {
-            "error": "Failed to fetch cart details before checkout",
-            "details": cart_details,
-        }
-    # Safely extract cost fields
-    cost_info = cart_details.get("cost") or {}
-    # Fallback: compute total as subtotal + shipping + tax (values come back in cents)
-    subtotal_raw = float((cost_info.get("subtotal") or {}).get("value") or 0)
-    shipping_raw = float((cost_info.get("shipping") or {}).get("value") or 0)
-    tax_raw = float((cost_info.get("tax") or {}).get("value") or 0)
-    # convert cents to dollars
-    total_value = (subtotal_raw + shipping_raw + tax_raw) / 100
-    # assume single currency across fields
-    total_currency = (
-        (cost_info.get("subtotal") or {}).get("currency")
-        or (cost_info.get("shipping") or {}).get("currency")
-        or (cost_info.get("tax") or {}).get("currency")
-    )
+
+    # Prefer the cart this server cached from createCart over anything the client sends
+    cart_details = _CART_CACHE.get(cart_id)
+    if cart_details is None and cart_snapshot is not None:
+        # Accept either the createCart payload or its `cart`
+        cart_snapshot = cart_snapshot.get("cart", cart_snapshot)
+        if isinstance(cart_snapshot, dict) and _usable_cart_snapshot(
+            cart_snapshot, cart_id
+        ):
+            cart_details = cart_snapshot
+
+    if cart_details is None:
+        if not _RYE_CONFIGURED:
+            return {"error": "RYE_AUTH_HEADER or RYE_SHOPPER_IP not set"}
+
+        # Fetch cart details to capture cost and items
+        try:
+            data = await _rye_post(_Q_GET_CART, {"id": cart_id})
+        except UpstreamError as e:
+            return {
+                "error": "Failed to fetch cart details before checkout",
+                "details": e.as_response(),
+            }
+        except Exception as e:
+            return {
+                "error": "Failed to fetch cart details before checkout",
+                "details": str(e),
+            }
+        cart_details = _dig(data, "getCart", "cart")
+        if _dig(data, "getCart", "errors") or not cart_details:
+            return {
+                "error": "Failed to fetch cart details before checkout",
+                "details": _dig(data, "getCart", "errors") or data,
+            }
+    # Money stays in integer cents (as Rye returns it); Postgres derives the dollar amount
+    try:
+        total_cents, total_currency = _cart_total_cents(cart_details)
+    except ValueError as e:
+        return {"error": "Unexpected cart cost format", "details": str(e)}
     # Safely build items snapshot
-    items_snapshot = []
-    for store in cart_details.get("stores") or []:
-        for line in store.get("cartLines") or []:
-            prod = line.get("product") or {}
-            price = prod.get("price") or {}
-            items_snapshot.append(
-                {
-                    "productId": prod.get("id"),
-                    "title": prod.get("title"),
-                    "quantity": line.get("quantity"),
-                    "price_value": price.get("value"),
-                    "price_currency": price.get("currency"),
-                }
-            )
+    items_snapshot = [
+        {
+            "productId": _dig(line, "product", "id"),
+            "title": _dig(line, "product", "title"),
+            "quantity": line.get("quantity"),
+            "price_value": _dig(line, "product", "price", "value"),
+            "price_currency": _dig(line, "product", "price", "currency"),
+        }
+        for store in cart_details.get("stores") or ()
+        for line in store.get("cartLines") or ()
+    ]
     try:
-        supabase_client = create_client(supabase_url, supabase_key)
+        supabase_client = _get_supabase()
         # Build full order record
         order_data = {
             "rye_order_id": None,
             "rye_cart_id": cart_id,
             "user_identifier": buyer_info.get("email"),
             "status": "CREATED",
-            "total_amount_value": total_value,
+            "total_amount_value_cents": total_cents,
             "total_amount_currency": total_currency,
             "items_snapshot": items_snapshot,
         }
-        print(f"checkout_amazon_cart: inserting order_data = {order_data}")  # Debug
-        resp = supabase_client.table("orders").insert(order_data).execute()
-        if hasattr(resp, "error") and resp.error:
-            return {
-                "error": "Supabase insert failed",
-                "details": resp.error.message or str(resp.error),
-                "order_data": order_data,
-            }
+        resp = await _sb_exec(
+            supabase_client.table("orders").insert(order_data),
+            "Supabase insert failed",
+        )
         return {
             "status": "success",
             "order_data": order_data,
             "supabase_insert": resp.data,
         }
+    except UpstreamError as e:
+        return {**e.as_response(), "order_data": order_data}
     except Exception as e:
         return {"error": f"Checkout failed: {str(e)}"}
 
@@ -531,109 +776,100 @@ async def checkout_amazon_cart(cart_id: str, buyer_info: dict) -> dict:
 @mcp_server.tool()
 async def list_my_purchases(limit: int = 10) -> dict:
     """Fetches the latest `limit` purchases from the Supabase orders table."""
-    supabase_url = os.environ.get("SUPABASE_URL")
-    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-    if not supabase_url or not supabase_key:
+    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
         return {"error": "Supabase URL or key not set in environment."}
     try:
-        supabase_client: Client = create_client(supabase_url, supabase_key)
-        response = (
+        supabase_client = _get_supabase()
+        response = await _sb_exec(
             supabase_client.table("orders")
             .select("*")
             .order("ordered_at", desc=True)
-            .limit(limit)
-            .execute()
+            .limit(limit),
+            "Supabase query failed",
         )
-        if hasattr(response, "error") and response.error:
-            return {
-                "error": "Supabase query failed",
-                "details": (
-                    response.error.message
-                    if response.error.message
-                    else str(response.error)
-                ),
-            }
         return {"status": "success", "orders": response.data or []}
+    except UpstreamError as e:
+        return e.as_response()
     except Exception as e:
         return {"error": f"Unexpected error fetching purchases: {str(e)}"}
 
 
 # -------------------- Spending Limit Tools --------------------
+@functools.lru_cache(maxsize=1)
+def _utc_day_start(day: date) -> str:
+    """ISO timestamp of UTC midnight on `day`; cached, so it is built once per day."""
+    return datetime.combine(day, time.min, tzinfo=timezone.utc).isoformat()
+
+
 @mcp_server.tool()
 async def set_spending_limit(user_identifier: str, limit_value: float) -> dict:
     """Sets the daily spending limit for a user."""
-    supabase_url = os.environ.get("SUPABASE_URL")
-    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-    if not supabase_url or not supabase_key:
+    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
         return {"error": "Supabase URL or service role key not configured."}
     try:
-        sb = create_client(supabase_url, supabase_key)
-        resp = (
-            sb.table("spending_limits")
-            .upsert(
+        sb = _get_supabase()
+        resp = await _sb_exec(
+            sb.table("spending_limits").upsert(
                 {"user_identifier": user_identifier, "limit_value": limit_value},
                 on_conflict="user_identifier",
-            )
-            .execute()
+            ),
+            "Failed to set spending limit",
         )
-        if hasattr(resp, "error") and resp.error:
-            return {
-                "error": "Failed to set spending limit",
-                "details": resp.error.message,
-            }
         return {
             "status": "success",
             "message": f"Spending limit set to {limit_value} for {user_identifier}.",
             "data": resp.data,
         }
+    except UpstreamError as e:
+        return e.as_response()
     except Exception as e:
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
 
 @mcp_server.tool()
-async def get_spending_status(user_identifier: str) -> dict:
-    """Retrieves the daily spending limit and current day's spending for a user."""
-    supabase_url = os.environ.get("SUPABASE_URL")
-    supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-    if not supabase_url or not supabase_key:
+async def get_spending_status(
+    user_identifier: str, include_transactions: bool = False
+) -> dict:
+    """Retrieves the daily spending limit and current day's spending for a user.
+
+    Today's total is summed by the `spent_today` Postgres function; set
+    `include_transactions` to also return the individual orders placed today.
+    """
+    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
         return {"error": "Supabase URL or service role key not configured."}
     try:
-        sb = create_client(supabase_url, supabase_key)
-        # Get limit
-        limit_resp = (
-            sb.table("spending_limits")
-            .select("limit_value")
-            .eq("user_identifier", user_identifier)
-            .execute()
-        )
-        if hasattr(limit_resp, "error") and limit_resp.error:
-            return {
-                "error": "Failed to fetch spending limit",
-                "details": limit_resp.error.message,
-            }
+        sb = _get_supabase()
+        # The limit, today's total and today's orders are independent; fetch them concurrently
+        queries = [
+            _sb_exec(
+                sb.table("spending_limits")
+                .select("limit_value")
+                .eq("user_identifier", user_identifier),
+                "Failed to fetch spending limit",
+            ),
+            _sb_exec(
+                sb.rpc("spent_today", {"uid": user_identifier}),
+                "Failed to fetch today's spending",
+            ),
+        ]
+        if include_transactions:
+            today_start = _utc_day_start(datetime.now(timezone.utc).date())
+            queries.append(
+                _sb_exec(
+                    sb.table("orders")
+                    .select("total_amount_value, total_amount_currency, created_at")
+                    .eq("user_identifier", user_identifier)
+                    .gte("created_at", today_start),
+                    "Failed to fetch today's orders",
+                )
+            )
+        limit_resp, spent_resp, *orders = await asyncio.gather(*queries)
         if limit_resp.data and len(limit_resp.data) > 0:
             limit_value = float(limit_resp.data[0].get("limit_value", 0))
         else:
             limit_value = 1e30  # default very high
-        # Calculate today's spending
-        now = datetime.now(timezone.utc)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-        orders_resp = (
-            sb.table("orders")
-            .select("total_amount_value, total_amount_currency, created_at")
-            .eq("user_identifier", user_identifier)
-            .gte("created_at", today_start)
-            .execute()
-        )
-        if hasattr(orders_resp, "error") and orders_resp.error:
-            return {
-                "error": "Failed to fetch today's orders",
-                "details": orders_resp.error.message,
-            }
-        orders_today = orders_resp.data or []
-        total_spent = sum(
-            [float(o.get("total_amount_value", 0) or 0) for o in orders_today]
-        )
+        total_spent = float(spent_resp.data or 0)
+        orders_today = (orders[0].data or []) if include_transactions else None
         remaining = limit_value - total_spent
         # Advice for anti-retail therapy
         if total_spent >= limit_value:
@@ -642,19 +878,34 @@ async def get_spending_status(user_identifier: str) -> dict:
             advice = "You're getting close to your daily limit—maybe take a breath before splurging more."
         else:
             advice = "All clear! You have room to spend today."
-        return {
+        result = {
             "status": "success",
             "spending_limit": limit_value,
             "total_spent_today": total_spent,
             "remaining_limit": remaining,
-            "transactions_today": orders_today,
             "advice": advice,
         }
+        if orders_today is not None:
+            result["transactions_today"] = orders_today
+        return result
+    except UpstreamError as e:
+        return e.as_response()
     except Exception as e:
         return {"error": f"An unexpected error occurred: {str(e)}"}
 
 
 if __name__ == "__main__":
+    import sys
+
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools come with uvicorn[standard]; uvloop has no Windows build.
+    # Single worker: MCP sessions (streamable HTTP and SSE) and _CART_CACHE live in
+    # this process, so follow-up requests routed to another worker would fail.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+    )
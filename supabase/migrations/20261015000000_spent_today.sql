@@ -0,0 +1,15 @@
+-- Sum of a user's orders since UTC midnight, so get_spending_status can fetch
+-- one scalar instead of every order row for the day.
+create or replace function spent_today(uid text)
+returns numeric
+language sql
+stable
+as $$
+    select coalesce(sum(total_amount_value), 0)
+    from orders
+    where user_identifier = uid
+      and created_at >= date_trunc('day', now() at time zone 'utc') at time zone 'utc'
+$$;
+
+create index if not exists orders_user_identifier_created_at_idx
+    on orders (user_identifier, created_at desc);
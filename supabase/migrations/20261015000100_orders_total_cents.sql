@@ -0,0 +1,25 @@
+-- Store order totals as integer cents (Rye's unit) instead of float-derived
+-- dollars. total_amount_value stays available to readers as a generated
+-- column; the currency remains in total_amount_currency.
+alter table orders add column if not exists total_amount_value_cents bigint;
+
+update orders
+set total_amount_value_cents = round(total_amount_value * 100)
+where total_amount_value_cents is null;
+
+alter table orders drop column total_amount_value;
+alter table orders
+    add column total_amount_value numeric
+    generated always as (total_amount_value_cents / 100.0) stored;
+
+-- Sum the exact integer column
+create or replace function spent_today(uid text)
+returns numeric
+language sql
+stable
+as $$
+    select coalesce(sum(total_amount_value_cents), 0) / 100.0
+    from orders
+    where user_identifier = uid
+      and created_at >= date_trunc('day', now() at time zone 'utc') at time zone 'utc'
+$$;
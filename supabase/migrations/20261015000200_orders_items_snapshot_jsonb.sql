@@ -0,0 +1,20 @@
+-- Keep the checkout item snapshot as jsonb (the client sends it as a JSON
+-- array) and index it so orders can be filtered by product later, e.g.
+-- items_snapshot @> '[{"productId": "..."}]'.
+do $$
+begin
+    if (
+        select data_type
+        from information_schema.columns
+        where table_schema = 'public'
+          and table_name = 'orders'
+          and column_name = 'items_snapshot'
+    ) <> 'jsonb' then
+        alter table orders
+            alter column items_snapshot type jsonb using items_snapshot::jsonb;
+    end if;
+end
+$$;
+
+create index if not exists orders_items_snapshot_idx
+    on orders using gin (items_snapshot jsonb_path_ops);